@@ -10,19 +10,33 @@
 import random
 import typing
 import sys
-import copy
+import os
+import collections
 import time
 import threading
 import queue
 import numpy as np
 import datetime
+import math
+import itertools
+import multiprocessing
+import multiprocessing.shared_memory
+import multiprocessing.util
+import struct
+import atexit
 
 RandomSeed = None
 PossibleMoves = ["up", "down", "left", "right"]
 BestMove = "up"
-MoveLookup = {"left": -1, "right": 1, "up": 1, "down": -1}
+MoveIndex = {"up": 0, "down": 1, "left": 2, "right": 3}
 UseProbMiniMax = True
 UseProfiling = False
+UseNumpyFloodFill = False  #per board the bitboard fill is faster, numpy pays off on batches
+UseBatchedLeaves = False  #evaluate the leaves under a depth 2 node together with numpy
+MaxRoomScore = 10  #flood fill depth of calcRunwayScore
+UseAspirationWindows = False  #search each iteration in a window around the last value
+AspirationWindow = 20  #first half width of the window
+AspirationGrowth = 4  #the window grows by this factor after a failed search
 
 G_END_SPAN = 100
 G_END_SCORE = 100000000
@@ -31,6 +45,42 @@ SCORE_MIN = -G_END_SCORE - G_END_SPAN
 SCORE_GAME_END = G_END_SCORE
 SCORE_NEG_GAME_END = -G_END_SCORE
 
+TranspositionTableBits = 17
+TT_EXACT = 0
+TT_LOWER = 1  #value is a lower bound, the search failed high
+TT_UPPER = 2  #value is an upper bound, the search failed low
+ZobristSnakes = 16  #snakes beyond this share keys with earlier ones
+RELEASE_NEVER = 1 << 30  #release turn of cells that never free up (constrictor)
+KillerSlots = 2  #killer moves remembered per ply
+UseJointOpponentMoves = True  #opponents pick their moves one by one instead of all the same way
+OpponentBranchDistance = 6  #opponents farther than this from my head follow default_opponent_move
+MaxJointMoves = 27  #the farthest opponents stop branching until the joint moves fit
+Engine = "minimax"  #search used by move(), "minimax" or "mcts", set with --engine
+MctsExploration = 1.0  #UCB1 exploration constant, rewards are between 0 and 1
+MctsRolloutTurns = 8  #random turns played after a new node before it is evaluated
+MctsEvalScale = 100  #minimax_evaluate values are squashed to a reward on this scale
+Parallel = None  #"root" splits the root moves over processes, "smp" runs lazy SMP, set with --parallel
+Workers = 4  #processes of the search pool, set with --workers
+SearchPool = None  #multiprocessing pool made in __main__ when Parallel is set
+SearchPoolLock = threading.Lock()  #held by the move searching on SearchPool
+SharedTable = None  #transposition table in shared memory for "smp", see SharedTranspositionTable
+UsePondering = True  #keep searching the position after my move until the next request
+PonderTimeouts = 1  #a ponder search runs at most this many game timeouts when no request comes
+HAZARD_DAMAGE = 15  #hazard damage per turn when the ruleset does not give one
+DEFAULT_TIMEOUT = 500  #ms per move when the game does not say
+DefaultRoundTrip = 0.07  #seconds assumed for the network round trip until one is measured
+SafetyMargin = 0.03  #seconds kept for encoding the response and the Flask path
+MinBudget = 0.05  #the search always gets at least this many seconds
+IdleTimeouts = 10  #a game with no request for this many of its timeouts is dropped
+RoundTripSamples = 10  #the round trip estimate is the smallest of this many gaps
+PollInterval = 1000000  #ns between reads of the clock during a search
+MaxPollNodes = 256  #nodes between reads of the clock at most
+UsePartialRoot = True  #start a depth that can't finish when its first root move can, see make_minimax_iterating
+FirstMoveShare = 0.5  #share of an iteration the first root move is expected to take
+DefaultBranching = 5  #growth of an iteration over the one before until two are measured
+JoinGrace = 5000000  #ns past the deadline a move waits for its search before answering without it, less than SafetyMargin
+Searchers = None  #SearchThreads of this process, see search_threads
+
 # info is called when you create your Battlesnake on play.battlesnake.com
 # and controls your Battlesnake's appearance
 # TIP: If you open your Battlesnake URL in a browser you should see this data
@@ -48,171 +98,1146 @@ def info() -> typing.Dict:
 def start(gameState: typing.Dict):
   if RandomSeed is not None:
     random.seed(RandomSeed)
+  get_board_tables(gameState["board"]["width"], gameState["board"]["height"], gameState["game"]["map"])
+  get_game(gameState)
   print("GAME START")
 
 # end is called when your Battlesnake finishes a game
 def end(gameState: typing.Dict):
+  game = Games.pop(gameState["game"]["id"], None)
+  if game is not None:
+    game.ponderer.close()
   print("GAME OVER\n")
 
 # move is called on every turn and returns your next move
 def move(gameState: typing.Dict) -> typing.Dict:
-  endTime = datetime.datetime.now() + datetime.timedelta(seconds=0.4)
-  nextMove = make_minimax_move(gameState, endTime)
+  arrival = time.perf_counter()
+  now = datetime.datetime.now()
+  game = get_game(gameState)
+  budget = game.clock.budget(gameState, arrival)
+  endTime = now + datetime.timedelta(seconds=budget)
+  game.ponderer.stop()
+  game.ordering.age()
+  myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"])
+  safeMoves = safe_moves(myBoard, myBoard.me, 0)
+  if len(safeMoves) == 1:
+    # nothing to search, the tree of the last Monte Carlo search is off the game now
+    nextMove = safeMoves[0]
+    game.mcts = None
+    print("only safe move",nextMove)
+  elif Engine == "mcts":
+    nextMove = make_mcts_move(gameState, endTime, game)
+  elif SearchPool is not None and SearchPoolLock.acquire(blocking=False):
+    # one game at a time has the pool, its time is only split between moves
+    try:
+      if Parallel == "smp":
+        nextMove = make_smp_move(gameState, endTime)
+      else:
+        nextMove = make_root_split_move(gameState, endTime)
+    finally:
+      SearchPoolLock.release()
+  else:
+    if SearchPool is not None:
+      print("search pool busy with another game, searching in this process")
+    nextMove = make_minimax_move(gameState, endTime, game)
+  if UsePondering and Engine != "mcts" and SearchPool is None:
+    game.ponderer.ponder(gameState, nextMove)
+  game.lastState = gameState
+  game.lastMove = nextMove
+  game.clock.replied(gameState["turn"])
   print(f"MOVE {gameState['turn']}: {nextMove}")
   return {"move": nextMove}
 
-def avoid_walls(futureHead, boardWidth, boardHeight):
-  x = int(futureHead["x"])
-  y = int(futureHead["y"])
-  if x < 0 or y < 0 or x >= boardWidth or y >= boardHeight:
-    return False
-  else:
-    return True
+# Lookup tables for one board geometry, built once per game by start() and
+# shared by every board of the same width, height and map
+class BoardTables:
+  __slots__ = ("width", "height", "cells", "full", "notLeftColumn", "notRightColumn",
+               "neighbors", "neighborBits", "headKeys", "bodyKeys", "tailKeys",
+               "lengthKeys", "healthKeys", "foodKeys", "hazardKeys", "sideKey")
+
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    self.cells = width * height
+
+    # masks used to shift a whole bitboard by one cell without wrapping rows
+    self.full = (1 << self.cells) - 1
+    leftColumn = 0
+    for y in range(height):
+      leftColumn |= 1 << (y * width)
+    self.notLeftColumn = self.full & ~leftColumn
+    self.notRightColumn = self.full & ~(leftColumn << (width - 1))
+
+    # neighbors[cell][MoveIndex[move]] is the next cell, or -1 for a wall
+    self.neighbors = []
+    self.neighborBits = []
+    for cell in range(self.cells):
+      x = cell % width
+      y = cell // width
+      up = cell + width if y < height - 1 else -1
+      down = cell - width if y > 0 else -1
+      left = cell - 1 if x > 0 else -1
+      right = cell + 1 if x < width - 1 else -1
+      self.neighbors.append((up, down, left, right))
+      bits = 0
+      for next in (up, down, left, right):
+        if next >= 0:
+          bits |= 1 << next
+      self.neighborBits.append(bits)
+
+    # zobrist keys, seeded by the geometry so every process gets the same ones
+    rng = random.Random(f"zobrist {width}x{height}")
+    def keys(count):
+      return [rng.getrandbits(64) for i in range(count)]
+    self.headKeys = [keys(self.cells) for i in range(ZobristSnakes)]
+    self.bodyKeys = [keys(self.cells) for i in range(ZobristSnakes)]
+    self.tailKeys = [keys(self.cells) for i in range(ZobristSnakes)]
+    self.lengthKeys = [keys(self.cells + 8) for i in range(ZobristSnakes)]
+    self.healthKeys = [keys(256) for i in range(ZobristSnakes)]  #indexed by health & 255
+    self.foodKeys = keys(self.cells)
+    self.hazardKeys = keys(self.cells)
+    self.sideKey = rng.getrandbits(64)
+
+  # every cell one step away from any cell in bits
+  def grow(self, bits):
+    return (((bits << 1) & self.notLeftColumn) | ((bits >> 1) & self.notRightColumn) |
+            ((bits << self.width) & self.full) | (bits >> self.width))
+
+BoardTablesCache = {}
+
+def get_board_tables(width, height, mapName):
+  key = (width, height, mapName)
+  tables = BoardTablesCache.get(key)
+  if tables is None:
+    tables = BoardTables(width, height)
+    BoardTablesCache[key] = tables
+  return tables
+
+# A snake in the search. Cells are plain int indices y*width+x, the body is
+# a deque from head to tail and bits holds the same cells as a bitboard.
+class Snake:
+  __slots__ = ("id", "index", "health", "body", "bits")
+
+  def __init__(self, id, index, health, body):
+    self.id = id
+    self.index = index % ZobristSnakes  #my snake is always 0
+    self.health = health
+    self.body = collections.deque(body)
+    self.bits = 0
+    for part in body:
+      self.bits |= 1 << part
+
+  # the part of the zobrist key describing this snake
+  def key(self, tables):
+    key = tables.headKeys[self.index][self.body[0]] ^ tables.tailKeys[self.index][self.body[-1]]
+    key ^= tables.lengthKeys[self.index][len(self.body)] ^ tables.healthKeys[self.index][self.health & 255]
+    bits = self.bits
+    while bits:
+      bit = bits & -bits
+      key ^= tables.bodyKeys[self.index][bit.bit_length() - 1]
+      bits ^= bit
+    return key
+
+# The search runs on a bitboard copy of the game board: every cell is one bit
+# of a python int, bit index y*width+x. It is converted from the game JSON
+# once per move and then changed in place by minimax_make_move.
+class BitBoard:
+  __slots__ = ("tables", "map", "end", "winner", "undo", "food", "hazards", "hazardDamage",
+               "snakes", "me", "opponents", "key", "release")
+
+  def __init__(self, board, myId, mapName, hazardDamagePerTurn=HAZARD_DAMAGE):
+    self.tables = get_board_tables(board["width"], board["height"], mapName)
+    self.map = mapName
+    self.end = False
+    self.winner = 0  #no winner by default
+    self.undo = []  #one record per applied move, see minimax_unmake_move
+
+    self.food = 0
+    for food in board["food"]:
+      self.food |= 1 << self.cell(food)
+
+    # hazards can be stacked, every copy on a cell adds its damage
+    self.hazards = 0
+    self.hazardDamage = [0] * self.tables.cells
+    for hazard in board.get("hazards", []):
+      cell = self.cell(hazard)
+      self.hazards |= 1 << cell
+      self.hazardDamage[cell] += hazardDamagePerTurn
+
+    self.snakes = []
+    self.me = None
+    self.opponents = []
+    for s in board["snakes"]:
+      index = 0 if s["id"] == myId else len(self.opponents) + 1
+      snake = Snake(s["id"], index, s["health"], [self.cell(part) for part in s["body"]])
+      self.snakes.append(snake)
+      if snake.id == myId:
+        self.me = snake
+      else:
+        self.opponents.append(snake)
+
+    # release[cell] is the first turn a head may move onto the cell. A body
+    # part leaves when the snake's tail has moved past it, one turn later if
+    # the snake has just eaten. Turns count from this board, every cell a
+    # snake head can enter right now holds a release turn <= 0.
+    self.release = [0] * self.tables.cells
+    for snake in self.snakes:
+      growth = 1 if snake.health == 100 else 0
+      fromTail = len(snake.body) - 1
+      for part in snake.body:
+        if mapName == "constrictor":
+          self.release[part] = RELEASE_NEVER
+        else:
+          self.release[part] = max(self.release[part], growth + fromTail)
+        fromTail -= 1
+
+    # zobrist key of the position, kept up to date by minimax_make_move
+    self.key = 0
+    food = self.food
+    while food:
+      bit = food & -food
+      self.key ^= self.tables.foodKeys[bit.bit_length() - 1]
+      food ^= bit
+    hazards = self.hazards
+    while hazards:
+      bit = hazards & -hazards
+      cell = bit.bit_length() - 1
+      self.key ^= (self.tables.hazardKeys[cell] * self.hazardDamage[cell]) & 0xFFFFFFFFFFFFFFFF
+      hazards ^= bit
+    for snake in self.snakes:
+      self.key ^= snake.key(self.tables)
+
+  def cell(self, point):
+    return point["y"] * self.tables.width + point["x"]
+
+  def bodies(self):
+    bits = 0
+    for snake in self.snakes:
+      bits |= snake.bits
+    return bits
 
-def avoid_snakes(futureHead, newBoard, currentSnake):
-  currentSnakeLen = len(currentSnake["body"])
-  for snake in newBoard["snakes"]:
-    snakeLen = len(snake["body"])    
-    if futureHead in snake["body"][1:-1]:
+def avoid_snakes(futureHead, myBoard, currentSnake, turn):
+  currentSnakeLen = len(currentSnake.body)
+  if myBoard.release[futureHead] > turn:
+    #another snake may move onto my head if it is longer than me
+    if futureHead != myBoard.me.body[0] or currentSnake is myBoard.me or len(myBoard.me.body) >= currentSnakeLen:
+      return False
+  bit = 1 << futureHead
+  for snake in myBoard.opponents:
+    #avoid being within 1 of another snake head that is >= my length
+    if snake is not currentSnake and len(snake.body) >= currentSnakeLen and myBoard.tables.neighborBits[snake.body[0]] & bit:
       return False
-    if snake["id"] != currentSnake["id"]:
-      if (snake["health"] == 100 or newBoard["map"] != "constrictor" or snake["id"] == newBoard["myId"]) and futureHead == snake["body"][-1]:
-        return False
-      elif snake["id"] == newBoard["myId"] and snakeLen >= currentSnakeLen:
-        #avoid connecting with another snake head that is >= my length and has moved already    
-        if futureHead == snake["body"][0]:
-          return False
-      elif snakeLen >= currentSnakeLen:
-        #avoid being within 1 of another snake head that is >= my length and has not moved yet
-        if abs(snake["body"][0]["x"]-futureHead["x"]) + abs(snake["body"][0]["y"]-futureHead["y"]) == 1:
-          return False
   return True  
 
-def get_next(currentHead, nextMove):
-  futureHead = {}
-  if nextMove == "left" or nextMove == "right":
-    futureHead["x"] = currentHead["x"] + MoveLookup[nextMove]
-    futureHead["y"] = currentHead["y"]
-  elif nextMove == "up" or nextMove == "down":
-    futureHead["x"] = currentHead["x"]
-    futureHead["y"] = currentHead["y"] + MoveLookup[nextMove]
-  return futureHead
-
-def make_minimax_move(gameState: typing.Dict, endTime):
+# returns the cell index after the move, or -1 for a wall
+def get_next(myBoard, cell, nextMove):
+  return myBoard.tables.neighbors[cell][MoveIndex[nextMove]]
+
+# Remembers search results by zobrist key. The table has a fixed number of
+# slots, a new result replaces the old one unless that is a deeper search of
+# the same position.
+class TranspositionTable:
+  __slots__ = ("mask", "entries")
+
+  def __init__(self, bits=TranspositionTableBits):
+    self.mask = (1 << bits) - 1
+    self.entries = [None] * (1 << bits)
+
+  # returns (key, depth, value, bound, move) or None
+  def probe(self, key):
+    entry = self.entries[key & self.mask]
+    if entry is not None and entry[0] == key:
+      return entry
+    return None
+
+  def store(self, key, depth, value, bound, move):
+    index = key & self.mask
+    entry = self.entries[index]
+    if entry is None or entry[0] != key or entry[1] <= depth:
+      self.entries[index] = (key, depth, value, bound, move)
+
+# The same table in shared memory so every process of the lazy SMP search
+# reads and writes one table. A slot is three 64 bit words: the key xored with
+# the other two, the packed depth, bound and move, and the value's float bits.
+# There are no locks, a slot torn by two writers fails the key check and
+# reads as empty.
+class SharedTranspositionTable:
+  __slots__ = ("mask", "memory", "words")
+
+  def __init__(self, name=None, bits=TranspositionTableBits):
+    self.mask = (1 << bits) - 1
+    if name is None:
+      self.memory = multiprocessing.shared_memory.SharedMemory(create=True, size=24 << bits)
+    else:
+      self.memory = multiprocessing.shared_memory.SharedMemory(name=name)
+    self.words = self.memory.buf.cast("Q")
+
+  def clear(self):
+    np.frombuffer(self.memory.buf, dtype=np.uint64)[:] = 0
+
+  def close(self, unlink=True):
+    self.words.release()
+    self.memory.close()
+    if unlink:
+      self.memory.unlink()
+
+  # returns (key, depth, value, bound, move) or None
+  def probe(self, key):
+    slot = (key & self.mask) * 3
+    words = self.words
+    data = words[slot + 1]
+    valueBits = words[slot + 2]
+    if words[slot] ^ data ^ valueBits != key or data == 0:
+      return None
+    return (key, data & 0xFF, struct.unpack("<d", struct.pack("<Q", valueBits))[0], (data >> 8) & 3, unpack_move(data >> 10))
+
+  def store(self, key, depth, value, bound, move):
+    slot = (key & self.mask) * 3
+    words = self.words
+    data = words[slot + 1]
+    if data != 0 and words[slot] ^ data ^ words[slot + 2] == key and (data & 0xFF) > depth:
+      return
+    data = depth | (bound << 8) | (pack_move(move) << 10) | (1 << 63)  #the top bit marks a used slot
+    valueBits = struct.unpack("<Q", struct.pack("<d", value))[0]
+    words[slot + 1] = data
+    words[slot + 2] = valueBits
+    words[slot] = key ^ data ^ valueBits
+
+# Moves packed into an int for SharedTranspositionTable. The low two bits say
+# what it is (none, one direction or a joint move), a joint move keeps its
+# length in the next five bits and then two bits per direction.
+def pack_move(move):
+  if move is None:
+    return 0
+  elif isinstance(move, str):
+    return 1 | (MoveIndex[move] << 2)
+  bits = 2 | (len(move) << 2)
+  for i in range(len(move)):
+    bits |= MoveIndex[move[i]] << (7 + 2 * i)
+  return bits
+
+def unpack_move(bits):
+  kind = bits & 3
+  if kind == 0:
+    return None
+  elif kind == 1:
+    return PossibleMoves[(bits >> 2) & 3]
+  return tuple(PossibleMoves[(bits >> (7 + 2 * i)) & 3] for i in range((bits >> 2) & 31))
+
+# Killer moves per ply and a history score per (snake, from cell, move),
+# both learned from the moves that turned out best in earlier nodes
+class MoveOrdering:
+  __slots__ = ("killers", "history")
+
+  def __init__(self):
+    self.killers = []  #up to KillerSlots moves per ply, newest first
+    self.history = {}  #(snake index, from cell, move) -> score
+
+  # forget the killers and halve the history, called before every turn so
+  # scores from old positions fade out and drop from the table
+  def age(self):
+    self.killers = []
+    self.history = {k: score >> 1 for k, score in self.history.items() if score > 1}
+
+  # history score of a move, summed over the snakes that make it
+  def score(self, snakes, move):
+    return sum(self.history.get((snake.index, snake.body[0], direction), 0)
+               for snake, direction in zip(snakes, move_directions(snakes, move)))
+
+  # reward the best move of a node, a cutoff move also becomes a killer
+  def update(self, snakes, move, ply, depth, cutoff):
+    for snake, direction in zip(snakes, move_directions(snakes, move)):
+      k = (snake.index, snake.body[0], direction)
+      self.history[k] = self.history.get(k, 0) + depth * depth
+    if cutoff:
+      while len(self.killers) <= ply:
+        self.killers.append([])
+      killers = self.killers[ply]
+      if move not in killers:
+        killers.insert(0, move)
+        del killers[KillerSlots:]
+
+# A move of the maximizing player is one direction for my snake, a move of
+# the minimizing player is a tuple with a direction for every opponent
+def move_directions(snakes, move):
+  return (move,) if isinstance(move, str) else move
+
+# What we keep about a game between turns, created by start() and dropped by end()
+class Game:
+  __slots__ = ("id", "timeout", "lastRequest", "ordering", "table", "pvMoves", "mcts", "lastState", "lastMove",
+               "clock", "ponderer")
+
+  def __init__(self, gameState: typing.Dict):
+    self.id = gameState["game"]["id"]
+    self.timeout = gameState["game"].get("timeout", DEFAULT_TIMEOUT) / 1000
+    self.lastRequest = time.perf_counter()  #when the last request of the game came
+    self.ordering = MoveOrdering()
+    self.table = TranspositionTable()  #kept between turns, pondering fills it
+    self.pvMoves = {}  #principal variation of the last search, position key -> move
+    self.mcts = None  #root MctsNode of the last Monte Carlo search
+    self.lastState = None  #game state of the last move request
+    self.lastMove = None  #the move we answered it with
+    self.clock = TimeManager()
+    self.ponderer = Ponderer(self)
+
+  # The joint move the opponents made since the last request, in the order of
+  # myBoard.opponents, or None when it can't be told, like when a snake died
+  def opponent_moves_since(self, gameState: typing.Dict, myBoard):
+    if self.lastState is None or self.lastState["turn"] + 1 != gameState["turn"]:
+      return None
+    lastBoard = BitBoard(self.lastState["board"], self.lastState["you"]["id"], self.lastState["game"]["map"])
+    if [s.id for s in lastBoard.opponents] != [s.id for s in myBoard.opponents]:
+      return None
+    moves = []
+    for last, now in zip(lastBoard.opponents, myBoard.opponents):
+      neighbors = lastBoard.tables.neighbors[last.body[0]]
+      if now.body[0] not in neighbors:
+        return None
+      moves.append(PossibleMoves[neighbors.index(now.body[0])])
+    return tuple(moves)
+
+# Search time per move: the game's timeout less the network round trip and a
+# safety margin. The engine reports in you.latency how long our answer to the
+# last turn took to reach it, less our own handling time that is the round
+# trip, whatever the other snakes did. The largest of the last few is used.
+# Without a latency the gap from our answer to the next request stands in.
+# That gap also holds the engine waiting for the other snakes, which a shorter
+# budget only makes longer, so a gap over DefaultRoundTrip is left out and the
+# smallest of the rest is used.
+class TimeManager:
+  __slots__ = ("roundTrips", "gaps", "lastTurn", "lastArrival", "lastReply")
+
+  def __init__(self):
+    self.roundTrips = collections.deque(maxlen=RoundTripSamples)  #from the reported latency
+    self.gaps = collections.deque(maxlen=RoundTripSamples)  #from our answer to the next request
+    self.lastTurn = None
+    self.lastArrival = None
+    self.lastReply = None
+
+  # seconds the search may use for this request
+  def budget(self, gameState: typing.Dict, arrival):
+    if self.lastTurn is not None and gameState["turn"] == self.lastTurn + 1:
+      latency = reported_latency(gameState)
+      if latency is not None:
+        self.roundTrips.append(max(0, latency - (self.lastReply - self.lastArrival)))
+      gap = arrival - self.lastReply
+      if gap <= DefaultRoundTrip:
+        self.gaps.append(gap)
+    self.lastArrival = arrival
+    timeout = gameState["game"].get("timeout", DEFAULT_TIMEOUT) / 1000
+    if len(self.roundTrips) > 0:
+      roundTrip = max(self.roundTrips)
+    elif len(self.gaps) > 0:
+      roundTrip = min(self.gaps)
+    else:
+      roundTrip = DefaultRoundTrip
+    budget = max(MinBudget, timeout - roundTrip - SafetyMargin)
+    print(f"TURN {gameState['turn']}: budget {budget * 1000:.0f}ms timeout {timeout * 1000:.0f}ms round trip {roundTrip * 1000:.0f}ms")
+    return budget
+
+  # called when the answer to a turn goes out
+  def replied(self, turn):
+    self.lastTurn = turn
+    self.lastReply = time.perf_counter()
+
+# seconds the engine says our last answer took, None when it doesn't say
+def reported_latency(gameState: typing.Dict):
+  try:
+    latency = float(gameState["you"].get("latency", 0))
+  except (TypeError, ValueError):
+    return None
+  return latency / 1000 if latency > 0 else None
+
+# A search run by SearchThreads. The thread that submitted it waits for it
+# with join() and cancel() aborts its search, which then returns at its next
+# node. A job cancelled before a thread took it returns at once.
+class SearchJob:
+  __slots__ = ("target", "search", "args", "background", "condition", "done", "result")
+
+  def __init__(self, target, search, args, background):
+    self.target = target  #called as target(search, *args)
+    self.search = search
+    self.args = args
+    self.background = background  #a ponder search, it waits while a move is searched
+    self.condition = threading.Condition()
+    self.done = False
+    self.result = None
+
+  def run(self):
+    try:
+      self.result = self.target(self.search, *self.args)
+    finally:
+      with self.condition:
+        self.done = True
+        self.condition.notify_all()
+
+  def cancel(self):
+    self.search.abort()
+
+  # wait until the job is done, or until the perf_counter_ns deadline if one
+  # is given, True when it is done
+  def join(self, deadline=None):
+    with self.condition:
+      if deadline is None:
+        self.condition.wait_for(lambda: self.done)
+      else:
+        self.condition.wait_for(lambda: self.done, max(0, deadline - time.perf_counter_ns()) / 1e9)
+      return self.done
+
+# Long lived threads that run SearchJobs, so a request doesn't start a thread
+# of its own. A thread is added whenever there are more jobs than idle
+# threads. The searches share one interpreter lock, so background searches
+# of every game pause while a move search is queued or running, see
+# yield_to_moves.
+class SearchThreads:
+  __slots__ = ("pid", "condition", "jobs", "idle", "threads", "moves")
+
+  def __init__(self):
+    self.pid = os.getpid()
+    self.condition = threading.Condition()
+    self.jobs = collections.deque()
+    self.idle = 0  #threads waiting for a job
+    self.threads = []
+    self.moves = 0  #move searches queued or running
+
+  def submit(self, target, search, *args, background=False):
+    job = SearchJob(target, search, args, background)
+    with self.condition:
+      if background:
+        search.threads = self
+      else:
+        self.moves += 1
+      self.jobs.append(job)
+      if self.idle < len(self.jobs):
+        thread = threading.Thread(target=self.run, daemon=True)
+        self.threads.append(thread)
+        thread.start()
+      # a paused background search waits on the same condition
+      self.condition.notify_all()
+    return job
+
+  def run(self):
+    while True:
+      with self.condition:
+        self.idle += 1
+        self.condition.wait_for(lambda: len(self.jobs) > 0)
+        self.idle -= 1
+        job = self.jobs.popleft()
+      try:
+        job.run()
+      except Exception as error:
+        print("search job failed:", repr(error))
+      finally:
+        if not job.background:
+          with self.condition:
+            self.moves -= 1
+            self.condition.notify_all()
+
+  # called by a background search, waits while there is a move to search
+  def yield_to_moves(self, search):
+    with self.condition:
+      self.condition.wait_for(lambda: self.moves == 0 or search.aborted)
+
+# the search threads of this process, a forked pool worker makes its own
+def search_threads():
+  global Searchers
+  if Searchers is None or Searchers.pid != os.getpid():
+    Searchers = SearchThreads()
+  return Searchers
+
+# Searches the position after the move we just sent while the other snakes
+# think, so the next search starts on a warm transposition table. It only
+# runs between a move and the next request, stop() ends the search before
+# the table is used again.
+class Ponderer:
+  __slots__ = ("game", "job")
+
+  def __init__(self, game):
+    self.game = game
+    self.job = None  #the SearchJob pondering now
+
+  def ponder(self, gameState: typing.Dict, move):
+    self.stop()
+    seconds = PonderTimeouts * gameState["game"].get("timeout", DEFAULT_TIMEOUT) / 1000
+    search = Search(datetime.datetime.now() + datetime.timedelta(seconds=seconds),
+                    self.game.ordering, self.game.table)
+    self.job = search_threads().submit(ponder_search, search, gameState, move, background=True)
+
+  # end the running search and wait until the table is free
+  def stop(self):
+    if self.job is not None:
+      self.job.cancel()
+      self.job.join()
+      self.job = None
+
+  def close(self):
+    self.stop()
+
+# SearchJob of the Ponderer, deepens the reply to my move
+def ponder_search(search, gameState: typing.Dict, move):
+  myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"],
+                     get_hazard_damage(gameState))
+  values = deepen_reply(search, myBoard, move)
+  print("pondered", move, "to depth", max(values) + 1 if isinstance(values, dict) and len(values) > 0 else 0)
+
+Games = {}
+
+# The game's state, made on the fly if start() was never called for it. Games
+# with no request for IdleTimeouts of their timeouts are dropped on the way,
+# their /end may never come and each holds a full transposition table.
+def get_game(gameState: typing.Dict):
+  now = time.perf_counter()
+  for game in list(Games.values()):
+    if now - game.lastRequest > IdleTimeouts * game.timeout:
+      print("dropping idle game",game.id)
+      Games.pop(game.id, None)
+      game.ponderer.close()
+  game = Games.get(gameState["game"]["id"])
+  if game is None:
+    game = Game(gameState)
+    Games[game.id] = game
+  game.lastRequest = now
+  return game
+
+# State shared by every node of one search. The deadline is kept on the
+# perf_counter_ns clock, which out_of_time only reads every checkEvery nodes.
+# checkEvery follows the measured node rate so the clock is read about once
+# per PollInterval. Once the deadline has passed, aborted stays set and every
+# node returns at once. A background search pauses at those reads while a
+# move search of any game is queued or running.
+class Search:
+  __slots__ = ("endTime", "deadline", "nodes", "nextCheck", "checkEvery", "lastCheck", "lastCheckNodes",
+               "aborted", "table", "ordering", "pv", "pvMoves", "researches", "rootPly", "rootMove", "threads")
+
+  def __init__(self, endTime, ordering=None, table=None):
+    self.endTime = endTime
+    now = time.perf_counter_ns()
+    self.deadline = now + int((endTime - datetime.datetime.now()).total_seconds() * 1e9)
+    self.nodes = 0
+    self.nextCheck = 0
+    self.checkEvery = 1
+    self.lastCheck = now
+    self.lastCheckNodes = 0
+    self.aborted = False
+    self.table = table if table is not None else TranspositionTable()
+    self.ordering = ordering if ordering is not None else MoveOrdering()
+    self.pv = []  #principal variation of the last finished iteration
+    self.pvMoves = {}  #position key -> move along that variation
+    self.researches = 0  #aspiration searches that failed and were repeated
+    self.rootPly = -1  #ply of the root of make_minimax_iterating
+    self.rootMove = None  #best root move of the running iteration that finished its search
+    self.threads = None  #SearchThreads a background search pauses for
+
+  # count a node, True when the search has to stop
+  def out_of_time(self):
+    self.nodes += 1
+    if self.nodes >= self.nextCheck:
+      if self.threads is not None and self.threads.moves > 0:
+        self.threads.yield_to_moves(self)
+        self.lastCheck = time.perf_counter_ns()
+      now = time.perf_counter_ns()
+      if now >= self.deadline:
+        self.aborted = True
+      elapsed = now - self.lastCheck
+      if elapsed > 0:
+        # follow the node rate, but only double at a time since it varies
+        rate = (self.nodes - self.lastCheckNodes) * PollInterval // elapsed
+        self.checkEvery = max(1, min(MaxPollNodes, 2 * self.checkEvery, rate))
+      self.lastCheck = now
+      self.lastCheckNodes = self.nodes
+      self.nextCheck = self.nodes + self.checkEvery
+    return self.aborted
+
+  # read the clock now, True when the search has to stop
+  def expired(self):
+    if not self.aborted and time.perf_counter_ns() >= self.deadline:
+      self.aborted = True
+    return self.aborted
+
+  # stop the search from another thread
+  def abort(self):
+    self.aborted = True
+    if self.threads is not None:
+      with self.threads.condition:
+        self.threads.condition.notify_all()
+
+# hazard damage per turn from the game's ruleset settings
+def get_hazard_damage(gameState: typing.Dict):
+  settings = gameState["game"].get("ruleset", {}).get("settings", {})
+  return settings.get("hazardDamagePerTurn", HAZARD_DAMAGE)
+
+# Iterative deepening minimax. With a game, its move ordering and table carry
+# over from the last turn and so does the principal variation: its positions
+# keep their keys, so the part that came true is searched first again.
+def make_minimax_move(gameState: typing.Dict, endTime, game=None):
   # this code will iterate as long as there is time
-  gameState["board"]["myId"] = gameState["you"]["id"]
-  gameState["board"]["map"] = gameState["game"]["map"]
+  myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"],
+                     get_hazard_damage(gameState))
   results = queue.LifoQueue()
-  make_minimax_iterating(gameState, results, endTime)
+  if game is None:
+    search = Search(endTime)
+  else:
+    search = Search(endTime, game.ordering, game.table)
+    search.pvMoves = game.pvMoves
+    entry = game.table.probe(myBoard.key)
+    if entry is not None:
+      print("table has this position to depth",entry[1])
+  job = search_threads().submit(make_minimax_iterating, search, myBoard, results)
+  # the search stops itself at the deadline, one that runs on past JoinGrace
+  # is cancelled. It returns at its next node, it is waited for all the same
+  # so nothing else uses the board, the table or the move ordering before it
+  # has unwound.
+  if not job.join(search.deadline + JoinGrace):
+    print("search ran past its deadline")
+    job.cancel()
+    job.join()
+  if game is not None:
+    game.pvMoves = search.pvMoves
   
   if results.qsize() > 0:
-    return results.get_nowait()
+    return results.get_nowait()[2]
   else:
+    myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"])
     goodMoves = []
     for move in PossibleMoves:
-      next = get_next(gameState["you"]["body"][0], move)
-      if avoid_walls(next, gameState["board"]["width"], gameState["board"]["height"]):
-        if avoid_snakes(next, gameState["board"], gameState["you"]):
-          goodMoves.append(move)
+      next = get_next(myBoard, myBoard.me.body[0], move)
+      if next >= 0 and avoid_snakes(next, myBoard, myBoard.me, 0):
+        goodMoves.append(move)
     if len(goodMoves) > 0:
       return random.choice(goodMoves)
     else:
       return random.choice(PossibleMoves)
 
-def make_minimax_iterating(gameState, queue, endTime):
-  depth = 2
-  times = []
-  times.append(datetime.datetime.now())
-  while datetime.datetime.now() < endTime and depth < 100:
-    myBoard = copy.deepcopy(gameState["board"])
-    myBoard["myId"] = gameState["you"]["id"]
-    myBoard["map"] = gameState["game"]["map"]
-    myBoard["end"] = False
-    myBoard["winner"] = 0  #no winner by default
-    value, move = minimax(endTime, myBoard, depth, True, SCORE_MIN, SCORE_MAX)
-    times.append(datetime.datetime.now())
+# Search the root moves in parallel on SearchPool, each worker deepens its own
+# move until its share of the time is up. With fewer workers than moves the
+# moves are searched in rounds and every round gets the same share. The move
+# values are compared at the deepest depth every move got to.
+def make_root_split_move(gameState: typing.Dict, endTime):
+  rounds = math.ceil(len(PossibleMoves) / Workers)
+  seconds = (endTime - datetime.datetime.now()).total_seconds() / rounds
+  tasks = [(gameState, move, seconds, endTime) for move in PossibleMoves]
+  result = SearchPool.map_async(root_split_worker, tasks)
+  wait = (endTime - datetime.datetime.now()).total_seconds() + JoinGrace / 1e9
+  try:
+    results = result.get(timeout=max(wait, 0))
+  except multiprocessing.TimeoutError:
+    print("root split timed out")
+    return make_minimax_move(gameState, datetime.datetime.now())
+
+  # a move that ends the game has its value at every depth, one no worker
+  # got to before the deadline has none
+  skipped = [move for move, values in zip(PossibleMoves, results) if isinstance(values, dict) and len(values) == 0]
+  if len(skipped) > 0:
+    print("root split did not search",skipped,"with",Workers,"workers")
+  searched = [values for values in results if isinstance(values, dict) and len(values) > 0]
+  if len(searched) == 0:
+    return make_minimax_move(gameState, datetime.datetime.now())
+  depth = min(max(values) for values in searched)
+  bestValue = SCORE_MIN
+  bestMoves = []
+  for move, values in zip(PossibleMoves, results):
+    if isinstance(values, dict):
+      if depth not in values:
+        continue
+      value = values[depth]
+    else:
+      value = values
+    if value == bestValue:
+      bestMoves.append(move)
+    elif value > bestValue:
+      bestValue = value
+      bestMoves = [move]
+  print("root split depth",depth + 1,"values",dict(zip(PossibleMoves, results)))
+  # nothing is known of a move no worker got to, that beats a known loss
+  if bestValue <= SCORE_NEG_GAME_END and len(skipped) > 0:
+    myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"])
+    safeSkipped = [move for move in skipped if move in safe_moves(myBoard, myBoard.me, 0)]
+    if len(safeSkipped) > 0:
+      return random.choice(safeSkipped)
+  return random.choice(bestMoves)
+
+# Worker of make_root_split_move, searches one root move with deepen_reply for
+# its share of the time, but not past the move's deadline
+def root_split_worker(task):
+  gameState, move, seconds, endTime = task
+  myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"],
+                     get_hazard_damage(gameState))
+  taskEnd = min(endTime, datetime.datetime.now() + datetime.timedelta(seconds=seconds))
+  return deepen_reply(Search(taskEnd), myBoard, move)
+
+# Make my move and deepen the minimizing node under it until the search's
+# deadline. Returns the game end value if the move ends the game, else a
+# dict of depth -> value for every depth done.
+def deepen_reply(search, myBoard, move):
+  minimax_make_move(myBoard, move, True)
+  if myBoard.end:
+    return game_end_value(myBoard)
+  values = {}
+  depth = 1
+  while not search.expired() and depth < 100:
+    value, reply = minimax(search, myBoard, depth, False, SCORE_MIN, SCORE_MAX)
+    if search.aborted:
+      break
+    values[depth] = value
+    if abs(value) >= SCORE_GAME_END: #proven, deeper searches find the same
+      break
+    depth += 2
+  return values
+
+# Lazy SMP: every worker of SearchPool runs the whole iterative deepening on
+# the same shared transposition table, so they skip what the others already
+# searched. Odd workers start a depth later to spread the work out. The move
+# of the deepest iteration wins, a partial one only beats the depths before.
+def make_smp_move(gameState: typing.Dict, endTime):
+  SharedTable.clear()
+  tasks = [(gameState, endTime, worker) for worker in range(Workers)]
+  result = SearchPool.map_async(smp_worker, tasks)
+  wait = (endTime - datetime.datetime.now()).total_seconds() + JoinGrace / 1e9
+  try:
+    results = result.get(timeout=max(wait, 0))
+  except multiprocessing.TimeoutError:
+    print("lazy smp timed out")
+    return make_minimax_move(gameState, datetime.datetime.now())
+
+  finished = [r for r in results if r is not None]
+  if len(finished) == 0:
+    return make_minimax_move(gameState, datetime.datetime.now())
+  depth, complete, move = max(finished, key=lambda r: (r[0], r[1]))
+  print("lazy smp depth",depth,"complete" if complete else "partial","best move",move,"workers",results)
+  return move
+
+# Worker of make_smp_move, returns (depth, complete, move) of its deepest
+# iteration or None
+def smp_worker(task):
+  gameState, endTime, worker = task
+  myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"],
+                     get_hazard_damage(gameState))
+  search = Search(endTime, None, SharedTable)
+  results = queue.LifoQueue()
+  make_minimax_iterating(search, myBoard, results, 2 + 2 * (worker % 2))
+  return results.get_nowait() if results.qsize() > 0 else None
+
+# attaches a pool worker to the shared table made by the main process, a
+# forked worker already has it
+def attach_shared_table(name):
+  global SharedTable
+  if SharedTable is None or SharedTable.memory.name != name:
+    SharedTable = SharedTranspositionTable(name)
+  multiprocessing.util.Finalize(None, SharedTable.close, kwargs={"unlink": False}, exitpriority=10)
+
+# Iterative deepening, two plies at a time, until the root value is a game
+# end. Every iteration puts (depth, complete, move) on the queue. An
+# iteration costs about the one before times the effective branching factor,
+# the ratio of their node counts, so an iteration that can't finish in the
+# time left is not started. With UsePartialRoot it is still started when its
+# first root move, the principal variation, can finish: once that move is
+# done, a move that beats it is a better move even if the deadline cuts the
+# rest off. Such a result is not complete.
+def make_minimax_iterating(search, myBoard, queue, depth=2):
+  search.rootPly = len(myBoard.undo)
+  lastValue = None
+  lastNodes = None
+  while not search.expired() and depth < 100:
+    start = time.perf_counter_ns()
+    startNodes = search.nodes
+    value, move = minimax_aspiration(search, myBoard, depth, lastValue)
+    now = time.perf_counter_ns()
     
-    if datetime.datetime.now() < endTime:
-      if value <= SCORE_NEG_GAME_END: #detect a hopeless situation and exit early 
+    if search.aborted:
+      if search.rootMove in PossibleMoves:
+        print("partial iteration depth",depth,"best move",search.rootMove)
+        queue.put((depth, False, search.rootMove))
+      return
+
+    lastValue = value
+    if value <= SCORE_NEG_GAME_END: #detect a hopeless situation and exit early 
+      return
+    elif move in PossibleMoves:
+      principal_variation(search, myBoard, depth)
+      print("iteration depth",depth,"best move",move,"pv",search.pv,"re-searches",search.researches)
+      queue.put((depth, True, move))
+      if value >= SCORE_GAME_END: #a proven win, deeper iterations find the same
+        print("proven win in",G_END_SPAN - (value - SCORE_GAME_END) - search.rootPly,"plies")
         return
-      elif move in PossibleMoves:
-        print("iteration depth",depth,"best move",move)
-        queue.put(move)
     
     depth += 2
-    if times[-1] - times[-2] >= endTime - datetime.datetime.now():
+    nodes = search.nodes - startNodes
+    branching = DefaultBranching if lastNodes is None else max(1, nodes / max(1, lastNodes))
+    lastNodes = nodes
+    predicted = (now - start) * branching
+    remaining = search.deadline - now
+    if predicted * (FirstMoveShare if UsePartialRoot else 1) >= remaining:
+      print("skipping depth",depth,"branching",round(branching, 1),"predicted",predicted // 1000000,"ms left",remaining // 1000000,"ms")
       return
 
   return
 
-def minimax(endTime, myBoard, depth, maximizingPlayer, alpha, beta):
-  if datetime.datetime.now() >= endTime:
+# Search the root in a window around the value of the previous iteration and
+# widen the side that failed until the value lands inside. Without a previous
+# value, or when it is a game end, the full window is used.
+def minimax_aspiration(search, myBoard, depth, guess):
+  if not UseAspirationWindows or guess is None or abs(guess) >= SCORE_GAME_END:
+    return minimax(search, myBoard, depth, True, SCORE_MIN, SCORE_MAX)
+
+  window = AspirationWindow
+  alpha = guess - window
+  beta = guess + window
+  while True:
+    value, move = minimax(search, myBoard, depth, True, alpha, beta)
+    if search.aborted:
+      return (value, move)
+    if value < alpha:
+      window *= AspirationGrowth
+      alpha = max(SCORE_MIN, guess - window)
+    elif value > beta:
+      window *= AspirationGrowth
+      beta = min(SCORE_MAX, guess + window)
+    else:
+      return (value, move)
+    search.researches += 1
+
+# Follow the transposition table moves from the root to get the principal
+# variation of the iteration that just finished, the next iteration searches
+# these moves first. The walk stops where the table has no move. At a
+# probabilistic minimizing node the stored move is a reply sampled by its
+# weight, not the best reply, so past one the variation is only a likely line.
+def principal_variation(search, myBoard, depth):
+  search.pv = []
+  search.pvMoves = {}
+  maximizingPlayer = True
+  while len(search.pv) < depth and not myBoard.end:
+    entry = search.table.probe(myBoard.key)
+    if entry is None or entry[4] is None or myBoard.key in search.pvMoves:
+      break
+    search.pv.append(entry[4])
+    search.pvMoves[myBoard.key] = entry[4]
+    minimax_make_move(myBoard, entry[4], maximizingPlayer)
+    maximizingPlayer = not maximizingPlayer
+  for move in search.pv:
+    minimax_unmake_move(myBoard)
+
+# The moves of a node with the best known move of this position first: the
+# principal variation move, else the move the transposition table remembers.
+# Then come the killers of this ply and the rest by history score.
+def ordered_moves(search, myBoard, entry, movers, moves):
+  first = search.pvMoves.get(myBoard.key)
+  if first is None and entry is not None:
+    first = entry[4]
+  if first not in moves:
+    first = None
+  ordering = search.ordering
+  ply = len(myBoard.undo)
+  killers = ordering.killers[ply] if ply < len(ordering.killers) else []
+  killers = [move for move in killers if move != first and move in moves]
+  rest = [move for move in moves if move != first and move not in killers]
+  rest.sort(key=lambda move: -ordering.score(movers, move))
+  moves = killers + rest
+  return moves if first is None else [first] + moves
+
+# Joint moves of the opponents, a tuple with one direction per opponent.
+# Opponents close to my head try every move that doesn't run into a wall or
+# a body, the others follow default_opponent_move. While there are more than
+# MaxJointMoves combinations the farthest branching opponent stops branching.
+def opponent_moves(myBoard):
+  if not UseJointOpponentMoves:
+    return [(move,) * len(myBoard.opponents) for move in PossibleMoves]
+  return list(itertools.product(*opponent_choices(myBoard, MaxJointMoves)))
+
+# The moves each opponent branches on, see opponent_moves. maxJointMoves None
+# leaves the number of combinations unbounded.
+def opponent_choices(myBoard, maxJointMoves):
+  turn = len(myBoard.undo) // 2
+  distances = snake_distances(myBoard, 1 << myBoard.me.body[0], OpponentBranchDistance + 1)
+  choices = []
+  for snake in myBoard.opponents:
+    if distances[snake.body[0]] > OpponentBranchDistance:
+      choices.append([default_opponent_move(myBoard, snake, turn)])
+    else:
+      choices.append(safe_moves(myBoard, snake, turn) or [PossibleMoves[0]])
+
+  if maxJointMoves is None:
+    return choices
+  count = 1
+  for moves in choices:
+    count *= len(moves)
+  farthest = sorted(range(len(choices)), key=lambda i: -distances[myBoard.opponents[i].body[0]])
+  for i in farthest:
+    if count <= maxJointMoves:
+      break
+    if len(choices[i]) > 1:
+      count //= len(choices[i])
+      choices[i] = [default_opponent_move(myBoard, myBoard.opponents[i], turn)]
+  return choices
+
+# the moves of a snake that don't run into a wall or a body
+def safe_moves(myBoard, snake, turn):
+  neighbors = myBoard.tables.neighbors[snake.body[0]]
+  moves = []
+  for move in PossibleMoves:
+    next = neighbors[MoveIndex[move]]
+    if next >= 0 and avoid_snakes(next, myBoard, snake, turn):
+      moves.append(move)
+  return moves
+
+# Cheap policy of an opponent that doesn't branch: keep going straight when
+# that is safe, else take the first safe move
+def default_opponent_move(myBoard, snake, turn):
+  neighbors = myBoard.tables.neighbors
+  head = snake.body[0]
+  safeMoves = safe_moves(myBoard, snake, turn)
+  if len(snake.body) > 1 and snake.body[1] != head:
+    straight = PossibleMoves[neighbors[snake.body[1]].index(head)]
+    if straight in safeMoves:
+      return straight
+  return safeMoves[0] if len(safeMoves) > 0 else PossibleMoves[0]
+
+def minimax(search, myBoard, depth, maximizingPlayer, alpha, beta):
+  if search.out_of_time():
     return (0, "---")
-  bestMoves = PossibleMoves
-  bestValue = 0
-
-  if depth == 0 or myBoard["end"]:
-    if myBoard["end"]:
-      #print("game end", depth, myBoard["winner"])
-      return (myBoard["winner"], "---")      
-
-    estimate = 0
-    maxRoomScore = 10
-    for snake in myBoard["snakes"]:
-      if snake["id"] == myBoard["myId"]:
-        estimate -= calcFoodScore(myBoard, snake)
-        estimate += calcHazardScore(myBoard, snake)
-        estimate += calcLengthScore(snake)
-        estimate += calcRunwayScore(myBoard, snake, maxRoomScore)
-      else:
-        estimate += calcFoodScore(myBoard, snake)
-        estimate -= calcHazardScore(myBoard, snake)
-        estimate -= calcLengthScore(snake)
-        estimate -= calcRunwayScore(myBoard, snake, maxRoomScore)
 
-    return (estimate, "---")
+  if depth == 0 or myBoard.end:
+    if myBoard.end:
+      #print("game end", depth, myBoard.winner)
+      return (game_end_value(myBoard), "---")      
+    return (minimax_evaluate(myBoard), "---")
+
+  ply = len(myBoard.undo)
+  entry = search.table.probe(myBoard.key)
+  if entry is not None and entry[1] >= depth:
+    value = from_table_value(entry[2], ply)
+    if entry[3] == TT_EXACT or (entry[3] == TT_LOWER and value > beta) or (entry[3] == TT_UPPER and value < alpha):
+      return (value, entry[4])
+
+  value, move = minimax_children(search, myBoard, depth, maximizingPlayer, alpha, beta, entry)
+  # results cut short by the deadline are not worth remembering
+  if not search.aborted:
+    if value < alpha:
+      bound = TT_UPPER
+    elif value > beta:
+      bound = TT_LOWER
+    else:
+      bound = TT_EXACT
+    search.table.store(myBoard.key, depth, to_table_value(value, ply), bound, move if move != "---" else None)
+  return (value, move)
+
+# A game end scored by how far it is from the start of the search: the same
+# winner at a lower ply scores more, so a win is taken as soon as possible
+# and a loss put off as long as possible. G_END_SPAN is the farthest ply told
+# apart.
+def game_end_value(myBoard):
+  span = max(0, G_END_SPAN - len(myBoard.undo))
+  if myBoard.winner >= SCORE_GAME_END:
+    return myBoard.winner + span
+  elif myBoard.winner <= SCORE_NEG_GAME_END:
+    return myBoard.winner - span
+  return myBoard.winner
+
+# The table keeps game end values as the distance from the stored position,
+# which holds at whatever ply the position comes up again
+def to_table_value(value, ply):
+  if value >= SCORE_GAME_END:
+    return value + ply
+  elif value <= SCORE_NEG_GAME_END:
+    return value - ply
+  return value
+
+def from_table_value(value, ply):
+  if value >= SCORE_GAME_END:
+    return value - ply
+  elif value <= SCORE_NEG_GAME_END:
+    return value + ply
+  return value
+
+# Search every move of an inner node, best known move first, returns (value, move)
+def minimax_children(search, myBoard, depth, maximizingPlayer, alpha, beta, entry):
+  if depth == 2 and maximizingPlayer and UseBatchedLeaves:
+    return minimax_leaf_batch(myBoard)
+
+  if maximizingPlayer:
+    movers = [myBoard.me]
+    moves = ordered_moves(search, myBoard, entry, movers, PossibleMoves)
+  else:
+    movers = myBoard.opponents
+    moves = ordered_moves(search, myBoard, entry, movers, opponent_moves(myBoard))
+  ordering = search.ordering
+  ply = len(myBoard.undo)
+
   if maximizingPlayer:
+    root = ply == search.rootPly
+    if root:
+      search.rootMove = None
     bestValue = SCORE_MIN
     bestMoves = []
-    for move in PossibleMoves:
-      if datetime.datetime.now() >= endTime:
+    for move in moves:
+      if search.aborted:
         return (0, "---")
       #print("my",depth,move)
-      newBoard = minimax_new_board(myBoard, move, maximizingPlayer)
-      value, m = minimax(endTime, newBoard, depth - 1, not maximizingPlayer, alpha, beta)
+      minimax_make_move(myBoard, move, maximizingPlayer)
+      value, m = minimax(search, myBoard, depth - 1, not maximizingPlayer, alpha, beta)
+      minimax_unmake_move(myBoard)
+      # a finished root move above alpha is the best so far, see make_minimax_iterating
+      if root and value > alpha and not search.aborted:
+        search.rootMove = move
       if value == bestValue:
         bestMoves = bestMoves + [move]
       elif value > bestValue:
         bestValue = value
         bestMoves = [move]
-      if not UseProbMiniMax:
-        alpha = max(alpha, bestValue)
-        if beta < alpha: #modified from <=
-          break
+      alpha = max(alpha, bestValue)
+      if beta < alpha: #modified from <=
+        ordering.update(movers, move, ply, depth, True)
+        return (bestValue, move)
     #print("my",depth,bestValue,bestMoves)
-    return (bestValue, random.choice(bestMoves))
+    bestMove = random.choice(bestMoves)
+    ordering.update(movers, bestMove, ply, depth, False)
+    return (bestValue, bestMove)
   else:  # minimizing player
     bestValue = SCORE_MAX
     bestMoves = []
-    qs, ps = [], []
-    x, S = 0, 0
-    for move in PossibleMoves:
-      if datetime.datetime.now() >= endTime:
+    lossMove = None  #the move of bestValue when every move loses
+    qs = []
+    for i in range(len(moves)):
+      move = moves[i]
+      if search.aborted:
         return (0, "---")
       #print("other",depth,move)
-      newBoard = minimax_new_board(myBoard, move, maximizingPlayer)
-      value, m = minimax(endTime, newBoard, depth - 1, not maximizingPlayer, alpha, beta)
+      if UseProbMiniMax:
+        # a child at or below childAlpha is enough to fail low, so it only has
+        # to be searched that far
+        childAlpha = SCORE_MIN
+        if alpha > SCORE_NEG_GAME_END:
+          childAlpha = expected_value_child_alpha(qs, len(moves) - i, alpha)
+        minimax_make_move(myBoard, move, maximizingPlayer)
+        value, m = minimax(search, myBoard, depth - 1, not maximizingPlayer, childAlpha, SCORE_MAX)
+      else:
+        minimax_make_move(myBoard, move, maximizingPlayer)
+        value, m = minimax(search, myBoard, depth - 1, not maximizingPlayer, alpha, beta)
+      minimax_unmake_move(myBoard)
       if UseProbMiniMax:
         # if moves leads to an instant win, just take it
         if (value <= SCORE_NEG_GAME_END):
-          return (value, [move])
-        # if moves leads to instant loss, don't consider it
+          ordering.update(movers, move, ply, depth, True)
+          return (value, move)
+        # if moves leads to instant loss, don't consider it, but keep the
+        # latest loss in case every move leads to one
         elif (value >= SCORE_GAME_END):
+          if value < bestValue:
+            bestValue = value
+            lossMove = move
           continue
+        # the child failed low, value only bounds it from above
+        elif value < childAlpha:
+          ordering.update(movers, move, ply, depth, True)
+          return (expected_value_upper_bound(qs, len(moves) - i - 1, value), move)
         
         bestMoves = bestMoves + [move]
         qs.append(value)
-        x += (1.01**-value)      
+        # stop once the rest of the moves can't lift the value up to alpha
+        if alpha > SCORE_NEG_GAME_END and i + 1 < len(moves):
+          upper = expected_value_upper_bound(qs, len(moves) - i - 1)
+          if upper < alpha:
+            ordering.update(movers, move, ply, depth, True)
+            return (upper, move)
       else:
         if value == bestValue:
           bestMoves = bestMoves + [move]
@@ -221,223 +1246,636 @@ def minimax(endTime, myBoard, depth, maximizingPlayer, alpha, beta):
           bestMoves = [move]
         beta = min(beta, bestValue)
         if beta < alpha: #modified from <=
-          break
+          ordering.update(movers, move, ply, depth, True)
+          return (bestValue, move)
 
     if UseProbMiniMax:
-      # if no moves are added, all lead to instant loss, so give up
-      if (len(qs) == 0):
-        return (SCORE_GAME_END, random.choice(PossibleMoves))
-      
-      # if length is one, then there is only one option
-      elif (len(qs) == 1):
-        return (qs[0], bestMoves[0])
-      
-      # probability is calculated with a bias for negative numbers
-      for i in range(len(qs)):
-        ps.append((1.01**-qs[i]) / x)
-        S += ps[i] * qs[i]
-      if (len(qs) == 2):
-        return (S, random.choices(bestMoves, weights=[ps[0], ps[1]])[0])
-      elif (len(qs) == 3):
-        return (S, random.choices(bestMoves, weights=[ps[0], ps[1], ps[2]])[0])
-      else:
-        return (S, random.choice(PossibleMoves))
+      # the reply most likely to be played is the one with the lowest value
+      if len(qs) > 0:
+        ordering.update(movers, bestMoves[qs.index(min(qs))], ply, depth, False)
+      return minimax_expected_value(qs, bestMoves, bestValue, lossMove)
     
     #print("other",depth,bestValue,bestMoves)
-    return (bestValue, random.choice(bestMoves))
-
-# Make a board move
-def minimax_new_board(myBoard, move, maximizingPlayer):
-  newBoard = copyBoard(myBoard)
-
-  alreadyMovedSnakes = []
-  notAlreadyMovedSnakes = []
-  movingSnakes = []
-  for snake in newBoard["snakes"]:
-    if maximizingPlayer:
-      if snake["id"] == newBoard["myId"]:
-        movingSnakes.append(snake)
-        notAlreadyMovedSnakes.append(snake.copy())
-      else:
-        notAlreadyMovedSnakes.append(snake.copy())
+    bestMove = random.choice(bestMoves)
+    ordering.update(movers, bestMove, ply, depth, False)
+    return (bestValue, bestMove)
+
+# Bounds for cutting a probabilistic minimizing node short. A move of value
+# v is weighted w(v) = 1.01**-v, so adding it to the moves in qs, of weighted
+# mean m and total weight W, lifts the mean by at most w(v) * (v - m) / W.
+# That lift grows up to v = m + 1/ln(1.01) and falls after it, so a move
+# nothing is known about lifts the mean by at most its value at that peak.
+# Moves that win or lose instantly only lower the value or drop out, so the
+# bounds hold for them too.
+EXPECTED_VALUE_PEAK = 1 / math.log(1.01)
+
+def expected_value_mean(qs):
+  weight = 0
+  total = 0
+  for q in qs:
+    w = 1.01**-q
+    weight += w
+    total += w * q
+  return (total / weight, weight)
+
+def expected_value_lift(mean, value):
+  if value <= mean:
+    return 0
+  value = min(value, mean + EXPECTED_VALUE_PEAK)
+  return 1.01**-value * (value - mean)
+
+# Upper bound of the value minimax_expected_value will give once unknown more
+# moves are added to qs, plus one move known to be at most bounded if given
+def expected_value_upper_bound(qs, unknown, bounded=None):
+  if len(qs) == 0:
+    return SCORE_MAX
+  mean, weight = expected_value_mean(qs)
+  lift = unknown * expected_value_lift(mean, SCORE_MAX)
+  if bounded is not None:
+    lift += expected_value_lift(mean, bounded)
+  return mean + lift / weight
+
+# The highest value the next of unknown moves still to search can have while
+# the node stays below alpha, found by bisection since the lift is monotonic
+# below its peak. SCORE_MIN when no such value exists.
+def expected_value_child_alpha(qs, unknown, alpha):
+  if len(qs) == 0:
+    return SCORE_MIN
+  mean, weight = expected_value_mean(qs)
+  room = (alpha - mean) * weight - (unknown - 1) * expected_value_lift(mean, SCORE_MAX)
+  if room <= 0:
+    return SCORE_MIN
+  low = mean
+  high = mean + EXPECTED_VALUE_PEAK
+  for _ in range(12):
+    middle = (low + high) / 2
+    if expected_value_lift(mean, middle) < room:
+      low = middle
     else:
-      if snake["id"] == newBoard["myId"]:
-        alreadyMovedSnakes.append(snake)
-      else:
-        movingSnakes.append(snake)
-        notAlreadyMovedSnakes.append(snake.copy())
+      high = middle
+  return low
+
+# Value of a probabilistic minimizing node from the values of the moves that
+# neither win nor lose instantly, returns (value, move). win is the value of
+# the latest loss of the minimizing player among the other moves and winMove
+# the joint move leading to it.
+def minimax_expected_value(qs, bestMoves, win=SCORE_GAME_END, winMove=None):
+  ps = []
+  x, S = 0, 0
+  # if no moves are added, all lead to instant loss, so give up
+  if (len(qs) == 0):
+    return (win, winMove)
+  
+  # if length is one, then there is only one option
+  elif (len(qs) == 1):
+    return (qs[0], bestMoves[0])
+  
+  # probability is calculated with a bias for negative numbers
+  for q in qs:
+    x += (1.01**-q)
+  for i in range(len(qs)):
+    ps.append((1.01**-qs[i]) / x)
+    S += ps[i] * qs[i]
+  if (len(qs) == 2):
+    return (S, random.choices(bestMoves, weights=[ps[0], ps[1]])[0])
+  elif (len(qs) == 3):
+    return (S, random.choices(bestMoves, weights=[ps[0], ps[1], ps[2]])[0])
+  else:
+    return (S, random.choices(bestMoves, weights=ps)[0])
+
+# Heuristic value of a board that is not a game end
+def minimax_evaluate(myBoard):
+  foodDistances = food_distances(myBoard)
+  estimate = 0
+  for snake in myBoard.snakes:
+    if snake is myBoard.me:
+      estimate -= calcFoodScore(myBoard, snake, foodDistances)
+      estimate += calcHazardScore(myBoard, snake)
+      estimate += calcLengthScore(snake)
+      estimate += calcRunwayScore(myBoard, snake, MaxRoomScore)
+    else:
+      estimate += calcFoodScore(myBoard, snake, foodDistances)
+      estimate -= calcHazardScore(myBoard, snake)
+      estimate -= calcLengthScore(snake)
+      estimate -= calcRunwayScore(myBoard, snake, MaxRoomScore)
+  return estimate
+
+# Search a depth 2 node of the maximizing player in one pass: every leaf two
+# moves down is made once to record what the evaluation needs, all of them
+# are scored together by calcBatchScores, and the values are then combined
+# like minimax_children would. Every leaf gets scored, even the ones
+# alpha-beta could have cut without UseProbMiniMax.
+def minimax_leaf_batch(myBoard):
+  leaves = []
+  children = []
+  for move in PossibleMoves:
+    minimax_make_move(myBoard, move, True)
+    if myBoard.end:
+      children.append((move, game_end_value(myBoard), None))
+    else:
+      replies = []
+      for reply in opponent_moves(myBoard):
+        minimax_make_move(myBoard, reply, False)
+        if myBoard.end:
+          replies.append((reply, True, game_end_value(myBoard)))
+        else:
+          replies.append((reply, False, len(leaves)))
+          foodDistances = food_distances(myBoard)
+          leaves.append((list(myBoard.release), len(myBoard.undo) // 2,
+                         [(s.body[0], len(s.body), s.health, foodDistances[s.body[0]]) for s in myBoard.snakes]))
+        minimax_unmake_move(myBoard)
+      children.append((move, None, replies))
+    minimax_unmake_move(myBoard)
+
+  scores = calcBatchScores(myBoard, leaves, MaxRoomScore) if len(leaves) > 0 else []
+  bestValue = SCORE_MIN
+  bestMoves = []
+  for move, value, replies in children:
+    if replies is not None:
+      value = minimax_leaf_batch_min(replies, scores)
+    if value == bestValue:
+      bestMoves = bestMoves + [move]
+    elif value > bestValue:
+      bestValue = value
+      bestMoves = [move]
+  return (bestValue, random.choice(bestMoves))
+
+# the minimizing player's value over replies scored by minimax_leaf_batch
+def minimax_leaf_batch_min(replies, scores):
+  bestValue = SCORE_MAX
+  bestMoves = []
+  qs = []
+  for reply, ended, value in replies:
+    if not ended:
+      value = scores[value]
+    if UseProbMiniMax:
+      # if moves leads to an instant win, just take it
+      if (value <= SCORE_NEG_GAME_END):
+        return value
+      # if moves leads to instant loss, don't consider it
+      elif (value >= SCORE_GAME_END):
+        bestValue = min(bestValue, value)
+        continue
+      bestMoves.append(reply)
+      qs.append(value)
+    else:
+      bestValue = min(bestValue, value)
+  if UseProbMiniMax:
+    return minimax_expected_value(qs, bestMoves, bestValue)[0]
+  return bestValue
+
+# Make a board move in place, everything it changes goes on the undo stack
+def minimax_make_move(myBoard, move, maximizingPlayer):
+  changes = []
+  turn = len(myBoard.undo) // 2  #one turn is my move plus the opponents' move
+  myBoard.undo.append((myBoard.end, myBoard.winner, myBoard.food, myBoard.key, changes))
+  release = myBoard.release
+
+  tables = myBoard.tables
+  neighbors = tables.neighbors
+  key = myBoard.key ^ tables.sideKey
+  if maximizingPlayer:
+    movingSnakes = [myBoard.me]
+  else:
+    movingSnakes = myBoard.opponents
   
   hitWalls = []
   hitSnakes = []
   starvedSnakes = []
   eatenSnakes = []
   
-  for snake in movingSnakes:
-    next = get_next(snake["body"][0], move)
-    if not avoid_walls(next, newBoard["width"], newBoard["height"]):
-      hitWalls.append(snake["id"])
-    elif not avoid_snakes(next, newBoard, snake):
-      hitSnakes.append(snake["id"])
+  for snake, direction in zip(movingSnakes, move_directions(movingSnakes, move)):
+    next = neighbors[snake.body[0]][MoveIndex[direction]]
+    if next < 0 or not avoid_snakes(next, myBoard, snake, turn):
+      if next < 0:
+        hitWalls.append(snake)
+      else:
+        hitSnakes.append(snake)
+      # a snake that could not move keeps its whole body one more turn
+      if myBoard.map != "constrictor":
+        shift_release(release, snake, 1, True)
+        changes.append((snake, None, 0, -1, 0, False))
     else:
-      snake["body"].insert(0, next)
+      bit = 1 << next
+      poppedTail = -1
+      oldHealth = snake.health
+      oldBits = snake.bits
+      index = snake.index
+      key ^= tables.headKeys[index][snake.body[0]] ^ tables.headKeys[index][next]
+      key ^= tables.tailKeys[index][snake.body[-1]] ^ tables.lengthKeys[index][len(snake.body)]
+      snake.body.appendleft(next)
+      snake.bits |= bit
       ateFood = False
-      for food in newBoard["food"]:
-        if food["x"] == next["x"] and food["y"] == next["y"]:
-          ateFood = True
-          newBoard["food"].remove(food)
-          break
-      if snake["health"] < 100 and newBoard["map"] != "constrictor":
-        snake["body"].pop()
-      snake["health"] = snake["health"] - 1
-      if "hazards" in newBoard.keys():
-        for hazard in newBoard["hazards"]:
-          if hazard["x"] == next["x"] and hazard["y"] == next["y"]:
-            snake["health"] = snake["health"] - 15
+      if myBoard.food & bit:
+        ateFood = True
+        myBoard.food &= ~bit
+        key ^= tables.foodKeys[next]
+      if snake.health < 100 and myBoard.map != "constrictor":
+        poppedTail = snake.body.pop()
+        if poppedTail != snake.body[-1] and poppedTail != next:
+          snake.bits &= ~(1 << poppedTail)
+      snake.health = snake.health - 1 - myBoard.hazardDamage[next]
       if ateFood:
-        snake["health"] = 100
-      if snake["health"] < 1:
-        starvedSnakes.append(snake["id"])
+        snake.health = 100
+      if snake.health < 1:
+        starvedSnakes.append(snake)
+
+      # the new head leaves after the rest of the body, eating delays every part by a turn
+      oldRelease = release[next]
+      if myBoard.map == "constrictor":
+        release[next] = RELEASE_NEVER
+      else:
+        release[next] = turn + len(snake.body) + (1 if ateFood else 0)
+        if ateFood:
+          shift_release(release, snake, 1, False)
+
+      changed = snake.bits ^ oldBits
+      while changed:
+        changedBit = changed & -changed
+        key ^= tables.bodyKeys[index][changedBit.bit_length() - 1]
+        changed ^= changedBit
+      key ^= tables.tailKeys[index][snake.body[-1]] ^ tables.lengthKeys[index][len(snake.body)]
+      key ^= tables.healthKeys[index][oldHealth & 255] ^ tables.healthKeys[index][snake.health & 255]
+      changes.append((snake, oldHealth, oldBits, poppedTail, oldRelease, ateFood))
 
       # eat maximizing snake if possible
       # minimizing snake has not moved so cannot be eaten for certain
       if not maximizingPlayer:
-        for otherSnake in alreadyMovedSnakes:
-          if snake["body"][0] == otherSnake["body"][0] and len(snake["body"]) >= len(otherSnake["body"]):
-            eatenSnakes.append(otherSnake["id"])
+        if next == myBoard.me.body[0] and len(snake.body) >= len(myBoard.me.body):
+          eatenSnakes.append(myBoard.me)
+
+  myBoard.key = key
 
   # maximizing player loses if in any loss state
-  if newBoard["end"] == False and newBoard["myId"] in hitWalls:
-    newBoard["end"] = True
-    newBoard["winner"] = SCORE_NEG_GAME_END #minimizing player wins
-  if newBoard["end"] == False and newBoard["myId"] in hitSnakes:
-    newBoard["end"] = True
-    newBoard["winner"] = SCORE_NEG_GAME_END #minimizing player wins
-  if newBoard["end"] == False and newBoard["myId"] in starvedSnakes:
-    newBoard["end"] = True
-    newBoard["winner"] = SCORE_NEG_GAME_END #minimizing player wins
-  if newBoard["end"] == False and newBoard["myId"] in eatenSnakes:
-    newBoard["end"] = True
-    newBoard["winner"] = SCORE_NEG_GAME_END #minimizing player wins
+  if myBoard.end == False and myBoard.me in hitWalls:
+    myBoard.end = True
+    myBoard.winner = SCORE_NEG_GAME_END #minimizing player wins
+  if myBoard.end == False and myBoard.me in hitSnakes:
+    myBoard.end = True
+    myBoard.winner = SCORE_NEG_GAME_END #minimizing player wins
+  if myBoard.end == False and myBoard.me in starvedSnakes:
+    myBoard.end = True
+    myBoard.winner = SCORE_NEG_GAME_END #minimizing player wins
+  if myBoard.end == False and myBoard.me in eatenSnakes:
+    myBoard.end = True
+    myBoard.winner = SCORE_NEG_GAME_END #minimizing player wins
 
   # maximizing player only wins if all opponents die
   someOpponentsLive = False
   someOpponentsDie = False
-  for snake in newBoard["snakes"]:
-    if snake["id"] != newBoard["myId"]:
-      if snake["id"] in hitWalls or snake["id"] in hitSnakes or snake["id"] in starvedSnakes or snake["id"] in eatenSnakes:
-        someOpponentsDie = True
-      else:
-        someOpponentsLive = True
+  for snake in myBoard.opponents:
+    if snake in hitWalls or snake in hitSnakes or snake in starvedSnakes or snake in eatenSnakes:
+      someOpponentsDie = True
+    else:
+      someOpponentsLive = True
 
   if someOpponentsDie and not someOpponentsLive:
-    newBoard["end"] = True
-    newBoard["winner"] = SCORE_GAME_END  #maximizing player wins  
+    myBoard.end = True
+    myBoard.winner = SCORE_GAME_END  #maximizing player wins  
+
+# Take back the last minimax_make_move
+def minimax_unmake_move(myBoard):
+  myBoard.end, myBoard.winner, myBoard.food, myBoard.key, changes = myBoard.undo.pop()
+  release = myBoard.release
+  for snake, health, bits, poppedTail, oldRelease, ateFood in reversed(changes):
+    if health is None:
+      #the snake could not move
+      shift_release(release, snake, -1, True)
+      continue
+    if ateFood and myBoard.map != "constrictor":
+      shift_release(release, snake, -1, False)
+    release[snake.body[0]] = oldRelease
+    snake.body.popleft()
+    if poppedTail >= 0:
+      snake.body.append(poppedTail)
+    snake.health = health
+    snake.bits = bits
 
-  return newBoard
+# move the release turn of every body part by some turns, each cell once
+def shift_release(release, snake, turns, withHead):
+  previous = -1 if withHead else snake.body[0]
+  for part in snake.body:
+    if part != previous:
+      release[part] += turns
+      previous = part
 
-def calcFoodScore(myBoard, snake):
+def calcFoodScore(myBoard, snake, foodDistances):
   if snake is None:
     return 0
   else:
-    foodScore = myBoard["width"] + myBoard["height"]
-    head = snake["body"][0]
-    for food in myBoard["food"]:
-      foodScore = min(foodScore, abs(food["x"] - head["x"]) + abs(food["y"] - head["y"]))
-    return foodScore
+    return foodDistances[snake.body[0]]
+
+# Path distance from every snake head to its nearest food, capped at width +
+# height, which is also what a head gets when no food can be reached
+def food_distances(myBoard):
+  return snake_distances(myBoard, myBoard.food, myBoard.tables.width + myBoard.tables.height)
+
+# Path distance from every snake head to the nearest cell of sources, from one
+# breadth first search spreading out of all of them at once. Snake bodies
+# block the search, except tails that move away next turn, and a head counts
+# as reached as soon as a ring touches it. Heads farther than maxDistance, or
+# not reached at all, get maxDistance.
+def snake_distances(myBoard, sources, maxDistance):
+  tables = myBoard.tables
+  turn = len(myBoard.undo) // 2
+  passable = tables.full & ~myBoard.bodies()
+  heads = 0
+  for s in myBoard.snakes:
+    heads |= 1 << s.body[0]
+    if myBoard.release[s.body[-1]] <= turn + 1:
+      passable |= 1 << s.body[-1]
+
+  distances = {}
+  discovered = sources
+  frontier = sources
+  found = frontier & heads
+  distance = 0
+  while True:
+    while found:
+      bit = found & -found
+      distances[bit.bit_length() - 1] = distance
+      found ^= bit
+    heads &= ~discovered
+    if heads == 0 or frontier == 0 or distance >= maxDistance:
+      break
+    ring = tables.grow(frontier) & ~discovered
+    discovered |= ring
+    found = ring & heads
+    frontier = ring & passable
+    distance += 1
+  while heads:
+    bit = heads & -heads
+    distances[bit.bit_length() - 1] = maxDistance
+    heads ^= bit
+  return distances
 
 def calcHazardScore(myBoard, snake):
-  if snake is None or "hazards" not in myBoard.keys():
+  if snake is None:
     return 0
+  elif myBoard.hazards & (1 << snake.body[0]):
+    return -115
   else:
-    next = snake["body"][0]
-    for hazard in myBoard["hazards"]:
-      if hazard["x"] == next["x"] and hazard["y"] == next["y"]:
-        return -115
     return 0
 
 def calcLengthScore(snake):
   if snake is None:
     return 0
   else:
-    return (len(snake["body"]) + int(snake["health"] / 100)) * 25
+    return (len(snake.body) + int(snake.health / 100)) * 25
 
 def calcRunwayScore(myBoard, snake, limit):
   if snake is None:
     return 0
   else:
-    #create snake body array to avoid
-    snakeLen = 0
-    for s in myBoard["snakes"]:
-      snakeLen += len(s["body"])
-    
-    snakeBodies = [0 for i in range(snakeLen)]
-    snakeCount = 0
-    for s in myBoard["snakes"]:
-      for part in s["body"]:
-        snakeBodies[snakeCount] = part["y"]*100+part["x"]
-        snakeCount += 1
-  
-    #create discovery nodes
-    discovered = [0 for i in range(121)]
-    distances = [0 for i in range(121)]
-    discovered[0] = snake["body"][0]["y"]*100+snake["body"][0]["x"]
-    count = 1
-    
-    index = 0
-    while index < count and distances[count-1] < limit:
-      node = discovered[index]
-
-      node -= 100
-      if node >= 0 and not node in snakeBodies and not node in discovered[:count]:
-        discovered[count] = node
-        distances[count] = distances[index] + 1
-        count += 1
-      node += 100
-
-      node += 100
-      if node//100 < myBoard["height"] and not node in snakeBodies and not node in discovered[:count]:
-        discovered[count] = node
-        distances[count] = distances[index] + 1
-        count += 1
-      node -= 100
-
-      node -= 1
-      if node%100 >= 0 and node%100 < 99 and not node in snakeBodies and not node in discovered[:count]:
-        discovered[count] = node
-        distances[count] = distances[index] + 1
-        count += 1
-      node += 1
-
-      node += 1
-      if node%100 < myBoard["width"] and not node in snakeBodies and not node in discovered[:count]:
-        discovered[count] = node
-        distances[count] = distances[index] + 1
-        count += 1
-      node -= 1
-
-      index += 1
-
-    return distances[count-1] * (int(25/limit) + 1)
-
-def copyBoard(myBoard):
-  newBoard = {}
-  newBoard["myId"] = myBoard["myId"]
-  newBoard["end"] = myBoard["end"]
-  newBoard["map"] = myBoard["map"]
-  newBoard["winner"] = myBoard["winner"]
-  newBoard["width"] = myBoard["width"]
-  newBoard["height"] = myBoard["height"]
-  newBoard["food"] = myBoard["food"].copy()
-  newBoard["hazards"] = myBoard["hazards"].copy()
-  newBoard["snakes"] = []
-  for s in myBoard["snakes"]:
-    newSnake = {}
-    newSnake["id"] = s["id"]
-    newSnake["health"] = s["health"]
-    newSnake["body"] = s["body"].copy()
-    newBoard["snakes"].append(newSnake)
-  return newBoard
-  
+    if UseNumpyFloodFill:
+      tables = myBoard.tables
+      release = np.array(myBoard.release).reshape(1, tables.height, tables.width)
+      distances, areas = flood_fill_numpy(release, [snake.body[0]], len(myBoard.undo) // 2, limit)
+      distance = int(distances[0])
+    else:
+      distance, area = flood_fill_bits(myBoard, snake.body[0], limit)
+
+    return distance * (int(25/limit) + 1)
+
+# minimax_evaluate for many boards at once. Every leaf is a tuple of its
+# release grid, turn and (head, length, health, food distance) per snake, in
+# myBoard.snakes order. Hazards don't change during a search, so they come
+# from myBoard.
+def calcBatchScores(myBoard, leaves, limit):
+  tables = myBoard.tables
+  boards = len(leaves)
+  snakeCount = len(myBoard.snakes)
+  snakes = np.array([leaf[2] for leaf in leaves], dtype=np.int64).reshape(boards, snakeCount, 4)
+  heads = snakes[:, :, 0]
+  signs = np.array([1 if s is myBoard.me else -1 for s in myBoard.snakes])
+
+  # food distances come from food_distances while the leaf was made
+  foodScores = snakes[:, :, 3]
+
+  hazardScores = np.zeros(heads.shape, dtype=np.int64)
+  if myBoard.hazards:
+    hazards = bits_to_numpy(tables, [myBoard.hazards])[0]
+    hazardScores[hazards[heads]] = -115
+
+  lengthScores = (snakes[:, :, 1] + np.trunc(snakes[:, :, 2] / 100).astype(np.int64)) * 25
+
+  # one flood fill per snake per board
+  release = np.array([leaf[0] for leaf in leaves]).reshape(boards, 1, tables.height, tables.width)
+  release = np.broadcast_to(release, (boards, snakeCount, tables.height, tables.width))
+  turns = np.repeat([leaf[1] for leaf in leaves], snakeCount)
+  distances, areas = flood_fill_numpy(release.reshape(-1, tables.height, tables.width), heads.reshape(-1), turns, limit)
+  runwayScores = distances.reshape(boards, snakeCount) * (int(25/limit) + 1)
+
+  scores = -foodScores + hazardScores + lengthScores + runwayScores
+  return (scores * signs).sum(axis=1).tolist()
+
+# bitboards to a (len(bitboards), cells) boolean array
+def bits_to_numpy(tables, bitboards):
+  size = (tables.cells + 7) // 8
+  data = np.frombuffer(b"".join(bits.to_bytes(size, "little") for bits in bitboards), dtype=np.uint8)
+  return np.unpackbits(data.reshape(len(bitboards), size), axis=1, bitorder="little")[:, :tables.cells].astype(bool)
+
+# Flood fill from the head one ring at a time, snake bodies block the fill
+# unless their part of the body has moved on by the time the ring is reached.
+# Returns how many rings deep the fill got, up to limit, and the number of
+# cells reached.
+def flood_fill_bits(myBoard, head, limit):
+  tables = myBoard.tables
+  release = myBoard.release
+  turn = len(myBoard.undo) // 2
+  lastTurn = turn + limit - 1
+  bodies = myBoard.bodies()
+  leaving = 0
+  for s in myBoard.snakes:
+    for part in reversed(s.body):
+      if release[part] > lastTurn:
+        break
+      leaving |= 1 << part
+
+  discovered = 1 << head
+  frontier = discovered
+  distance = 0
+  while distance < limit:
+    ring = tables.grow(frontier) & ~discovered
+    arriving = ring & leaving
+    ring &= ~bodies
+    while arriving:
+      bit = arriving & -arriving
+      if release[bit.bit_length() - 1] <= turn + distance:
+        ring |= bit
+      arriving ^= bit
+    if ring == 0:
+      break
+    discovered |= ring
+    frontier = ring
+    distance += 1
+  return distance, bin(discovered).count("1") - 1
+
+# The same flood fill on numpy grids, for a whole stack of boards at once.
+# release has shape (boards, height, width), heads holds one cell per board
+# and turn is the current turn, either one number or one per board. Each step
+# dilates the reached area by shifting it one cell in every direction.
+# Returns arrays of ring depths and reached cell counts.
+def flood_fill_numpy(release, heads, turn, limit):
+  boards, height, width = release.shape
+  reached = np.zeros(release.shape, dtype=bool)
+  reached.reshape(boards, -1)[np.arange(boards), heads] = True
+  frontier = reached.copy()
+  grown = np.empty_like(reached)
+  turn = np.asarray(turn).reshape(-1, 1, 1)
+  distances = np.zeros(boards, dtype=np.int32)
+  for step in range(limit):
+    grown[:] = False
+    grown[:, 1:, :] |= frontier[:, :-1, :]
+    grown[:, :-1, :] |= frontier[:, 1:, :]
+    grown[:, :, 1:] |= frontier[:, :, :-1]
+    grown[:, :, :-1] |= frontier[:, :, 1:]
+    frontier = grown & ~reached & (release <= turn + step)
+    growing = frontier.any(axis=(1, 2))
+    if not growing.any():
+      break
+    distances += growing
+    reached |= frontier
+  return distances, reached.sum(axis=(1, 2)) - 1
+
+# One position of the Monte Carlo search, a whole turn after its parent. In
+# decoupled UCT every snake keeps its own visit count and reward total for
+# each of its moves and picks one independently, the picks together make the
+# joint move that leads to a child.
+class MctsNode:
+  __slots__ = ("visits", "moves", "stats", "children")
+
+  def __init__(self):
+    self.visits = 0
+    self.moves = None  #per snake, me first and then myBoard.opponents
+    self.stats = None  #per snake, [visits, reward] for each of its moves
+    self.children = {}  #(my move, opponent moves) -> MctsNode
+
+  def expand(self, myBoard):
+    turn = len(myBoard.undo) // 2
+    # the statistics are per snake, so the opponents can all branch
+    self.moves = [safe_moves(myBoard, myBoard.me, turn) or PossibleMoves] + opponent_choices(myBoard, None)
+    self.stats = [[[0, 0.0] for move in moves] for moves in self.moves]
+
+  # UCB1 pick of every snake, returns the index of each snake's move
+  def select(self):
+    logVisits = math.log(self.visits + 1)
+    picks = []
+    for stats in self.stats:
+      best = -1
+      bestScore = -1.0
+      for i in range(len(stats)):
+        visits, reward = stats[i]
+        if visits == 0:
+          score = 1000 + random.random()  #every move is tried once first
+        else:
+          score = reward / visits + MctsExploration * math.sqrt(logVisits / visits)
+        if score > bestScore:
+          best = i
+          bestScore = score
+      picks.append(best)
+    return picks
+
+  def update(self, picks, reward):
+    self.visits += 1
+    for snake in range(len(picks)):
+      stats = self.stats[snake][picks[snake]]
+      stats[0] += 1
+      # the opponents play as one side against me
+      stats[1] += reward if snake == 0 else 1 - reward
+
+# Decoupled UCT search. With a game, the subtree its last search reached
+# through our move and the opponents' actual moves becomes the new root and
+# keeps its statistics. Food that spawned since is not in that tree, it only
+# shows up in the rollouts.
+def make_mcts_move(gameState: typing.Dict, endTime, game=None):
+  myBoard = BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"],
+                     get_hazard_damage(gameState))
+  root = None
+  if game is not None and game.mcts is not None:
+    opponentMoves = game.opponent_moves_since(gameState, myBoard)
+    if opponentMoves is not None:
+      root = game.mcts.children.get((game.lastMove, opponentMoves))
+    if root is not None:
+      print("mcts reused a subtree of",root.visits,"visits")
+  if root is None:
+    root = MctsNode()
+    root.expand(myBoard)
+  iterations = 0
+  while datetime.datetime.now() < endTime:
+    mcts_iterate(root, myBoard)
+    iterations += 1
+
+  visits = [stats[0] for stats in root.stats[0]]
+  bestMove = root.moves[0][visits.index(max(visits))]
+  print("mcts iterations",iterations,"best move",bestMove,"visits",dict(zip(root.moves[0], visits)))
+  if game is not None:
+    game.mcts = root
+  return bestMove
+
+# One selection, expansion, rollout and backup pass. The board is changed in
+# place and restored before returning.
+def mcts_iterate(root, myBoard):
+  path = []
+  node = root
+  made = 0
+  while True:
+    picks = node.select()
+    myMove = node.moves[0][picks[0]]
+    opponentMoves = tuple(node.moves[i + 1][picks[i + 1]] for i in range(len(myBoard.opponents)))
+    path.append((node, picks))
+    minimax_make_move(myBoard, myMove, True)
+    made += 1
+    if not myBoard.end:
+      minimax_make_move(myBoard, opponentMoves, False)
+      made += 1
+    if myBoard.end:
+      reward = mcts_reward(myBoard)
+      break
+    child = node.children.get((myMove, opponentMoves))
+    if child is None:
+      child = MctsNode()
+      node.children[(myMove, opponentMoves)] = child
+      child.expand(myBoard)
+      reward = mcts_rollout(myBoard)
+      break
+    node = child
+
+  for node, picks in path:
+    node.update(picks, reward)
+  for _ in range(made):
+    minimax_unmake_move(myBoard)
+
+# Play random safe moves for a few turns and score where that ends
+def mcts_rollout(myBoard):
+  made = 0
+  for _ in range(MctsRolloutTurns):
+    turn = len(myBoard.undo) // 2
+    minimax_make_move(myBoard, random.choice(safe_moves(myBoard, myBoard.me, turn) or PossibleMoves), True)
+    made += 1
+    if myBoard.end:
+      break
+    opponentMoves = tuple(random.choice(safe_moves(myBoard, snake, turn) or PossibleMoves) for snake in myBoard.opponents)
+    minimax_make_move(myBoard, opponentMoves, False)
+    made += 1
+    if myBoard.end:
+      break
+  reward = mcts_reward(myBoard)
+  for _ in range(made):
+    minimax_unmake_move(myBoard)
+  return reward
+
+# my reward for a board, 1 for a win, 0 for a loss and the squashed
+# evaluation in between
+def mcts_reward(myBoard):
+  if myBoard.end:
+    if myBoard.winner >= SCORE_GAME_END:
+      return 1.0
+    elif myBoard.winner <= SCORE_NEG_GAME_END:
+      return 0.0
+    return 0.5
+  return 1 / (1 + math.exp(-minimax_evaluate(myBoard) / MctsEvalScale))
+
 # Start server when `python main.py` is run
 if __name__ == "__main__":
   from server import run_server
@@ -448,6 +1886,19 @@ if __name__ == "__main__":
       port = sys.argv[i + 1]
     elif sys.argv[i] == '--seed':
       random_seed = int(sys.argv[i + 1])
+    elif sys.argv[i] == '--engine':
+      Engine = sys.argv[i + 1]
+    elif sys.argv[i] == '--parallel':
+      Parallel = sys.argv[i + 1]
+    elif sys.argv[i] == '--workers':
+      Workers = int(sys.argv[i + 1])
+  # the pool is started once and kept warm for every move
+  if Parallel == "root":
+    SearchPool = multiprocessing.Pool(Workers)
+  elif Parallel == "smp":
+    SharedTable = SharedTranspositionTable()
+    atexit.register(SharedTable.close)
+    SearchPool = multiprocessing.Pool(Workers, attach_shared_table, (SharedTable.memory.name,))
   run_server({
     "info": info,
     "start": start,
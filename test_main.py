@@ -0,0 +1,199 @@
+# Random board checks of the invariants the search relies on: unmaking a move
+# restores the board, the incremental zobrist key and release grid match the
+# ones of a board built from scratch, both flood fills agree and the pruned
+# probabilistic minimax gives the value of an unpruned search.
+# Run with: python -m pytest -q test_main.py
+
+import collections
+import datetime
+import random
+
+import numpy as np
+
+import main
+
+FAR = datetime.datetime.now() + datetime.timedelta(days=1)
+
+# a game state with snakes of random length placed on random free cells
+def random_state(seed, width=11, height=11, snakes=3, food=4, hazards=5, mapName="standard"):
+  rng = random.Random(seed)
+  taken = set()
+  snakeStates = []
+  while len(snakeStates) < snakes:
+    x, y = rng.randrange(width), rng.randrange(height)
+    if (x, y) in taken:
+      continue
+    body = [(x, y)]
+    length = rng.randint(3, 8)
+    while len(body) < length:
+      cx, cy = body[-1]
+      nexts = [(cx + dx, cy + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))]
+      nexts = [p for p in nexts if 0 <= p[0] < width and 0 <= p[1] < height and p not in taken and p not in body]
+      if len(nexts) == 0:
+        break
+      body.append(rng.choice(nexts))
+    if len(body) < 3:
+      continue
+    health = rng.randint(20, 99)
+    if rng.random() < 0.3:  #just ate, the tail is stacked
+      body.append(body[-1])
+      health = 100
+    taken.update(body)
+    parts = [{"x": p[0], "y": p[1]} for p in body]
+    snakeStates.append({"id": f"s{len(snakeStates)}", "name": f"s{len(snakeStates)}", "health": health,
+                        "body": parts, "head": parts[0], "length": len(parts)})
+  free = [(x, y) for x in range(width) for y in range(height) if (x, y) not in taken]
+  rng.shuffle(free)
+  return {
+    "game": {"id": f"test{seed}", "map": mapName, "timeout": 500,
+             "ruleset": {"name": "standard", "settings": {"hazardDamagePerTurn": 14}}},
+    "turn": 5,
+    "board": {"width": width, "height": height,
+              "food": [{"x": p[0], "y": p[1]} for p in free[:food]],
+              "hazards": [{"x": rng.randrange(width), "y": rng.randrange(height)} for i in range(hazards)],
+              "snakes": snakeStates},
+    "you": snakeStates[0],
+  }
+
+def make_board(gameState):
+  return main.BitBoard(gameState["board"], gameState["you"]["id"], gameState["game"]["map"],
+                       main.get_hazard_damage(gameState))
+
+# the game state of a board after some turns, to build a fresh board from
+def export_state(gameState, myBoard):
+  width = myBoard.tables.width
+  point = lambda cell: {"x": cell % width, "y": cell // width}
+  snakeStates = []
+  for snake in myBoard.snakes:
+    parts = [point(cell) for cell in snake.body]
+    snakeStates.append({"id": snake.id, "name": snake.id, "health": snake.health,
+                        "body": parts, "head": parts[0], "length": len(parts)})
+  board = dict(gameState["board"])
+  board["food"] = [point(cell) for cell in range(myBoard.tables.cells) if myBoard.food >> cell & 1]
+  board["snakes"] = snakeStates
+  return {"game": gameState["game"], "turn": gameState["turn"] + len(myBoard.undo) // 2,
+          "board": board, "you": snakeStates[0]}
+
+# everything make and unmake change
+def snapshot(myBoard):
+  return (myBoard.end, myBoard.winner, myBoard.food, myBoard.key, list(myBoard.release),
+          [(snake.id, snake.health, list(snake.body), snake.bits) for snake in myBoard.snakes])
+
+# the zobrist key computed from scratch
+def recomputed_key(myBoard):
+  tables = myBoard.tables
+  key = 0
+  for cell in range(tables.cells):
+    if myBoard.food >> cell & 1:
+      key ^= tables.foodKeys[cell]
+    if myBoard.hazards >> cell & 1:
+      key ^= (tables.hazardKeys[cell] * myBoard.hazardDamage[cell]) & 0xFFFFFFFFFFFFFFFF
+  for snake in myBoard.snakes:
+    key ^= snake.key(tables)
+  if len(myBoard.undo) % 2 == 1:
+    key ^= tables.sideKey
+  return key
+
+# Random games from random boards, check(myBoard) is called on every position
+# on the way down and again on the way back up
+def random_playouts(check, games=20, plies=24, mapName="standard"):
+  for seed in range(games):
+    gameState = random_state(seed, snakes=2 + seed % 3, mapName=mapName)
+    myBoard = make_board(gameState)
+    rng = random.Random(seed)
+    snapshots = []
+    check(gameState, myBoard)
+    while len(snapshots) < plies and not myBoard.end:
+      maximizingPlayer = len(myBoard.undo) % 2 == 0
+      if maximizingPlayer:
+        # mostly safe moves so the games last
+        moves = main.safe_moves(myBoard, myBoard.me, len(myBoard.undo) // 2) or main.PossibleMoves
+      else:
+        moves = main.opponent_moves(myBoard)
+      snapshots.append(snapshot(myBoard))
+      main.minimax_make_move(myBoard, rng.choice(moves), maximizingPlayer)
+      check(gameState, myBoard)
+    while len(snapshots) > 0:
+      main.minimax_unmake_move(myBoard)
+      assert snapshot(myBoard) == snapshots.pop()
+      check(gameState, myBoard)
+
+def test_unmake_restores_board():
+  random_playouts(lambda gameState, myBoard: None)
+  random_playouts(lambda gameState, myBoard: None, games=5, mapName="constrictor")
+
+def test_search_restores_board():
+  for seed in range(10):
+    myBoard = make_board(random_state(seed, snakes=2 + seed % 3))
+    before = snapshot(myBoard)
+    main.minimax(main.Search(FAR), myBoard, 4, True, main.SCORE_MIN, main.SCORE_MAX)
+    assert snapshot(myBoard) == before
+
+def test_key_matches_recomputed_key():
+  def check(gameState, myBoard):
+    assert myBoard.key == recomputed_key(myBoard)
+  random_playouts(check)
+  random_playouts(check, games=5, mapName="constrictor")
+
+def test_release_matches_fresh_board():
+  def check(gameState, myBoard):
+    if len(myBoard.undo) % 2 == 1 or myBoard.end:
+      return
+    fresh = make_board(export_state(gameState, myBoard))
+    turn = len(myBoard.undo) // 2
+    # a head on the cell a tail just left holds two release turns, the
+    # boards may keep either
+    owners = collections.Counter(cell for snake in myBoard.snakes for cell in set(snake.body))
+    for cell in range(myBoard.tables.cells):
+      if owners[cell] < 2:
+        # a fresh board counts turns from its own start, free cells read as free
+        assert max(0, myBoard.release[cell] - turn) == max(0, fresh.release[cell])
+    assert myBoard.key == fresh.key
+  random_playouts(check)
+
+def test_flood_fills_agree():
+  def check(gameState, myBoard):
+    if len(myBoard.undo) % 2 == 1 or myBoard.end:
+      return
+    tables = myBoard.tables
+    release = np.array(myBoard.release).reshape(1, tables.height, tables.width)
+    for snake in myBoard.snakes:
+      distance, area = main.flood_fill_bits(myBoard, snake.body[0], main.MaxRoomScore)
+      distances, areas = main.flood_fill_numpy(release, [snake.body[0]], len(myBoard.undo) // 2, main.MaxRoomScore)
+      assert (distance, area) == (int(distances[0]), int(areas[0]))
+  random_playouts(check)
+
+# Probabilistic minimax without transposition table, move ordering or cuts.
+# Where the minimizing player wins, the smallest game end value is taken, the
+# search may stop at any of them.
+def unpruned_value(myBoard, depth, maximizingPlayer):
+  if myBoard.end:
+    return main.game_end_value(myBoard)
+  if depth == 0:
+    return main.minimax_evaluate(myBoard)
+  values = []
+  for move in main.PossibleMoves if maximizingPlayer else main.opponent_moves(myBoard):
+    main.minimax_make_move(myBoard, move, maximizingPlayer)
+    values.append(unpruned_value(myBoard, depth - 1, not maximizingPlayer))
+    main.minimax_unmake_move(myBoard)
+  if maximizingPlayer:
+    return max(values)
+  if min(values) <= main.SCORE_NEG_GAME_END:
+    return min(values)
+  qs = [value for value in values if value < main.SCORE_GAME_END]
+  wins = [value for value in values if value >= main.SCORE_GAME_END]
+  return main.minimax_expected_value(qs, qs, min(wins) if len(wins) > 0 else main.SCORE_GAME_END)[0]
+
+def test_pruned_values_match_unpruned():
+  for seed in range(8):
+    myBoard = make_board(random_state(seed, width=7, height=7, snakes=2 + seed % 2, hazards=0))
+    search = main.Search(FAR)
+    for depth in (2, 4):
+      value, move = main.minimax(search, myBoard, depth, True, main.SCORE_MIN, main.SCORE_MAX)
+      expected = unpruned_value(myBoard, depth, True)
+      if abs(expected) >= main.SCORE_GAME_END:
+        # which of several game ends a cut stops at depends on move order
+        assert (value >= main.SCORE_GAME_END) == (expected >= main.SCORE_GAME_END)
+        assert (value <= main.SCORE_NEG_GAME_END) == (expected <= main.SCORE_NEG_GAME_END)
+      else:
+        assert abs(value - expected) <= 1e-9 * max(1, abs(expected))